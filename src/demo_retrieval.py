@@ -36,25 +36,31 @@ def run_partial(query_input: str, top_k: int = 10):
         # Move each query embedding to CPU so that it's on the same device as the stored embeddings.
         query_embeddings[adapter] = out.last_hidden_state[:, 0, :].squeeze(0).cpu()
     
+    # Stack the document embeddings into (N, D) matrices so that each branch is scored
+    # against every document with a single BLAS matrix-vector product on the CPU.
+    doc_ids = list(doc_embeddings)
+    docs = [doc_embeddings[eid] for eid in doc_ids]
+    doc_title = torch.stack([vals["emb_title"] for vals in docs])
+    doc_details = torch.stack([vals["emb_details"] for vals in docs])
+    doc_feature = torch.stack([vals["emb_feature"] for vals in docs])
+    
+    # Choose weights based on availability of the feature summary.
+    unavailable = torch.tensor([vals["record"]["feature_summary"] == "[UNAVAILABLE]" for vals in docs])
+    w_title = 0.1
+    w_details = torch.where(unavailable, 0.9, 0.6)
+    w_feature = torch.where(unavailable, 0.0, 0.3)
+    
     # Compute composite similarity scores.
-    scores = {}
-    for eid, vals in doc_embeddings.items():
-        rec = vals["record"]
-        # Choose weights based on availability of the feature summary.
-        if rec["feature_summary"] == "[UNAVAILABLE]":
-            w_title, w_details, w_feature = 0.1, 0.9, 0.0
-        else:
-            w_title, w_details, w_feature = 0.1, 0.6, 0.3
-        
-        sim_title = torch.dot(query_embeddings["title"], vals["emb_title"]).item()
-        sim_details = torch.dot(query_embeddings["details"], vals["emb_details"]).item()
-        sim_feature = torch.dot(query_embeddings["feature_summary"], vals["emb_feature"]).item()
-        total_score = w_title * sim_title + w_details * sim_details + w_feature * sim_feature
-        scores[eid] = total_score
+    with torch.no_grad():
+        total_scores = (w_title * (doc_title @ query_embeddings["title"])
+                        + w_details * (doc_details @ query_embeddings["details"])
+                        + w_feature * (doc_feature @ query_embeddings["feature_summary"]))
+        # Only the top_k documents are printed, so there is no need to sort all of them.
+        top_scores, top_rows = torch.topk(total_scores, k=min(top_k, len(doc_ids)))
+    ranked = [(doc_ids[row], score_val) for row, score_val in zip(top_rows.tolist(), top_scores.tolist())]
     
-    ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
     print(f"Top {top_k} results for query: '{query_input}' (partial model):")
-    for eid, score_val in ranked[:top_k]:
+    for eid, score_val in ranked:
         record = next(item for item in data if item["id"] == eid)
         print(f"ID: {record['id']}, Title: {record['title']}, Score: {score_val}")
 
@@ -84,15 +90,16 @@ def run_joint(query_input: str, top_k: int = 10):
     # Move the query embedding to CPU.
     query_emb = out.last_hidden_state[:, 0, :].squeeze(0).cpu()
     
-    scores = {}
-    for eid, vals in doc_embeddings.items():
-        d_emb = vals["embedding"]
-        score_val = torch.sum(query_emb * d_emb).item()
-        scores[eid] = score_val
+    # Score every document with a single matrix-vector product over the stacked embeddings.
+    doc_ids = list(doc_embeddings)
+    doc_matrix = torch.stack([doc_embeddings[eid]["embedding"] for eid in doc_ids])
+    with torch.no_grad():
+        # Only the top_k documents are printed, so there is no need to sort all of them.
+        top_scores, top_rows = torch.topk(doc_matrix @ query_emb, k=min(top_k, len(doc_ids)))
+    ranked = [(doc_ids[row], score_val) for row, score_val in zip(top_rows.tolist(), top_scores.tolist())]
     
-    ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
     print(f"Top {top_k} results for query: '{query_input}' (joint model):")
-    for eid, score_val in ranked[:top_k]:
+    for eid, score_val in ranked:
         record = next(item for item in data if item["id"] == eid)
         print(f"ID: {record['id']}, Title: {record['title']}, Score: {score_val}")
 
@@ -1,14 +1,20 @@
 import openml
 import json
+import textwrap
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 
-# Get a list of all datasets
-datasets_list = openml.datasets.list_datasets()
+# Number of datasets fetched from OpenML concurrently. The work is network-bound,
+# so threads spend most of their time waiting on HTTP responses.
+MAX_WORKERS = 32
 
-# Create a list to store dataset information
-dataset_info_list = []
-
-# Iterate through all datasets and store their information
-for dataset_id, dataset_info in datasets_list.items():
+def fetch_one(item):
+    """
+    Fetches a single dataset from OpenML and returns its entry (id, title, details and
+    feature names), or None if the dataset is missing data or cannot be fetched.
+    """
+    dataset_id, dataset_info = item
     try:
         dataset = openml.datasets.get_dataset(dataset_id)
         
@@ -37,14 +43,42 @@ for dataset_id, dataset_info in datasets_list.items():
                 "details": combined_details,
                 "feature_names": feature_names
             }
-            dataset_info_list.append(dataset_entry)
-            print(f"Processed dataset {dataset_id}: {dataset_info['name']}")
+            tqdm.write(f"Processed dataset {dataset_id}: {dataset_info['name']}")
+            return dataset_entry
         else:
-            print(f"Skipping dataset {dataset_id}: Missing or invalid data")
+            tqdm.write(f"Skipping dataset {dataset_id}: Missing or invalid data")
             
     except Exception as e:
-        print(f"Error fetching dataset {dataset_id}: {e}")
+        tqdm.write(f"Error fetching dataset {dataset_id}: {e}")
+    return None
+
+def fetch_all(items):
+    """
+    Yields fetch_one() results in the order of items while keeping at most
+    2 * MAX_WORKERS fetches in flight, so finished entries do not pile up in memory.
+    """
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fetch_one, item))
+            if len(pending) >= 2 * MAX_WORKERS:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# Get a list of all datasets
+datasets_list = openml.datasets.list_datasets()
 
-# Save the data as JSON
+# Fetch all datasets concurrently and stream each entry into the JSON array as soon as it
+# is ready, instead of holding every description in memory until the end. The output has
+# the same layout and order as json.dump(dataset_info_list, jsonfile, indent=2).
 with open('../data/data/1_raw_data/data_finder_paper_data.json', 'w', encoding='utf-8') as jsonfile:
-    json.dump(dataset_info_list, jsonfile, indent=2)
+    jsonfile.write("[")
+    count = 0
+    for entry in tqdm(fetch_all(datasets_list.items()), total=len(datasets_list), desc="Fetching datasets"):
+        if entry is None:
+            continue
+        jsonfile.write(",\n" if count else "\n")
+        jsonfile.write(textwrap.indent(json.dumps(entry, indent=2), "  "))
+        count += 1
+    jsonfile.write("\n]" if count else "]")
@@ -90,10 +90,6 @@ with torch.no_grad():
         out = model(**tokens)
         doc_emb_feature[eid] = out.last_hidden_state[:, 0, :].squeeze(0)
 
-# Define a helper function to compute the dot product between two embeddings.
-def dot_product(a: torch.Tensor, b: torch.Tensor) -> float:
-    return torch.dot(a, b).item()
-
 # Now, for every query, rank every document using the composite similarity score.
 # For a given query-document pair, we compute:
 #   sim = (w_title * dot(query_emb_title, doc_emb_title)
@@ -104,33 +100,28 @@ def dot_product(a: torch.Tensor, b: torch.Tensor) -> float:
 #   If document's feature_summary == "[UNAVAILABLE]": w_title=0.1, w_details=0.9, w_feature=0.0
 ranking = {}
 
+# Stack the document embeddings into (N, D) matrices, one row per document id, so that
+# each query is scored against every document on the device with a single host sync.
+doc_ids = list(doc_emb_title.keys())
+D_title = torch.stack([doc_emb_title[did] for did in doc_ids])
+D_details = torch.stack([doc_emb_details[did] for did in doc_ids])
+D_feature = torch.stack([doc_emb_feature[did] for did in doc_ids])
+
+# Per-document weights, chosen from the feature summary field of the original data.
+unavailable = torch.tensor([data_dict[did]["feature_summary"] == "[UNAVAILABLE]" for did in doc_ids],
+                           device=device)
+w_title = 0.1
+w_details = torch.where(unavailable, 0.9, 0.6)
+w_feature = torch.where(unavailable, 0.0, 0.3)
+
 with torch.no_grad():
     for qid in tqdm(query_emb_title.keys(), desc="Ranking queries", unit="query"):
-        scores = {}
-        # Query embeddings for this query.
-        q_title = query_emb_title[qid]
-        q_details = query_emb_details[qid]
-        q_feature = query_emb_feature[qid]
-
-        for did in doc_emb_title.keys():
-            # Document embeddings for this document.
-            d_title = doc_emb_title[did]
-            d_details = doc_emb_details[did]
-            d_feature = doc_emb_feature[did]
-
-            # Check the feature summary field from the original data.
-            record = data_dict[did]
-            if record["feature_summary"] == "[UNAVAILABLE]":
-                w_title, w_details, w_feature = 0.1, 0.9, 0.0
-            else:
-                w_title, w_details, w_feature = 0.1, 0.6, 0.3
-
-            sim_title = dot_product(q_title, d_title)
-            sim_details = dot_product(q_details, d_details)
-            sim_feature = dot_product(q_feature, d_feature)
-
-            composite_score = w_title * sim_title + w_details * sim_details + w_feature * sim_feature
-            scores[did] = composite_score
+        # Composite scores of this query against every document, kept on the device.
+        composite_scores = (w_title * (D_title @ query_emb_title[qid])
+                            + w_details * (D_details @ query_emb_details[qid])
+                            + w_feature * (D_feature @ query_emb_feature[qid]))
+        # Copy all of this query's scores to the host at once.
+        scores = dict(zip(doc_ids, composite_scores.tolist()))
 
         # Rank the document ids for this query in descending order of composite score.
         ranked_doc_ids = sorted(scores, key=scores.get, reverse=True)
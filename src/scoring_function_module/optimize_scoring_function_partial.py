@@ -1,98 +1,246 @@
+import hashlib
 import json
+import os
 import torch
-from transformers import AutoTokenizer
+from transformers import AutoConfig, AutoTokenizer
 from adapters import AutoAdapterModel
 from tqdm import tqdm
 
 # Set up device.
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# Load base model and tokenizer.
-tokenizer = AutoTokenizer.from_pretrained("allenai/specter2_base")
-model = AutoAdapterModel.from_pretrained("allenai/specter2_base")
-model.to(device)
+# The encoder runs under bfloat16 autocast on GPU and in full FP32 on CPU.
+use_autocast = device.type == "cuda"
 
-model.load_adapter("../data/weights/finetuned_adhoc_query_adapter_title", load_as="title")
-model.load_adapter("../data/weights/finetuned_adhoc_query_adapter_details", load_as="details")
-model.load_adapter("../data/weights/finetuned_adhoc_query_adapter_feature_summary", load_as="feature_summary")
-model.to(device)
-model.eval()
+BASE_MODEL = "allenai/specter2_base"
+ADAPTER_PATHS = {
+    "title": "../data/weights/finetuned_adhoc_query_adapter_title",
+    "details": "../data/weights/finetuned_adhoc_query_adapter_details",
+    "feature_summary": "../data/weights/finetuned_adhoc_query_adapter_feature_summary",
+}
+DATA_PATH = "../data/data/3_final_data/final_valid.json"
+
+# Precomputed embeddings are saved here and reused on later runs with the same inputs.
+EMBEDDING_CACHE_PATH = "../data/data/2_intermediate_data/partial_rep_embeddings_val.pt"
+
+# Each adapter encodes the queries and its own document field:
+# (adapter, document field, document max_length).
+adapter_passes = [
+    ("title", "title", 128),
+    ("details", "details", 512),
+    ("feature_summary", "feature_summary", 512),
+]
 
 # Load the training data.
-with open("../data/data/3_final_data/final_valid.json", "r", encoding="utf-8") as f:
+with open(DATA_PATH, "r", encoding="utf-8") as f:
     data = json.load(f)
 
 # Prebuild a mapping from id to data record to avoid repeated linear searches.
 data_dict = {item["id"]: item for item in data}
 
-# Dictionaries to cache embeddings for queries and documents.
-# For each id, we will store three separate embeddings.
-query_emb_title = {}
-query_emb_details = {}
-query_emb_feature = {}
-
-doc_emb_title = {}
-doc_emb_details = {}
-doc_emb_feature = {}
-
-# Precompute and cache embeddings for each data point.
-# We compute query embeddings (using each adapter) on the element["query"]
-# and document embeddings on the corresponding fields.
-with torch.no_grad():
-    for element in tqdm(data, desc="Computing embeddings"):
-        eid = element["id"]
-        query_text = element["query"]
-        title_text = element["title"]
-        details_text = element["details"]
-        feature_text = element["feature_summary"]
-
-        # --- Query embeddings ---
-        # Title adapter.
-        tokens = tokenizer(query_text, return_tensors="pt", padding=True,
-                           truncation=True, max_length=128).to(device)
-        model.set_active_adapters("title")
-        out = model(**tokens)
-        query_emb_title[eid] = out.last_hidden_state[:, 0, :].squeeze(0)
-
-        # Details adapter.
-        tokens = tokenizer(query_text, return_tensors="pt", padding=True,
-                           truncation=True, max_length=128).to(device)
-        model.set_active_adapters("details")
-        out = model(**tokens)
-        query_emb_details[eid] = out.last_hidden_state[:, 0, :].squeeze(0)
-
-        # Feature summary adapter.
-        tokens = tokenizer(query_text, return_tensors="pt", padding=True,
-                           truncation=True, max_length=128).to(device)
-        model.set_active_adapters("feature_summary")
-        out = model(**tokens)
-        query_emb_feature[eid] = out.last_hidden_state[:, 0, :].squeeze(0)
-
-        # --- Document embeddings ---
-        # For title.
-        tokens = tokenizer(title_text, return_tensors="pt", padding=True,
-                           truncation=True, max_length=128).to(device)
-        model.set_active_adapters("title")
-        out = model(**tokens)
-        doc_emb_title[eid] = out.last_hidden_state[:, 0, :].squeeze(0)
-
-        # For details.
-        tokens = tokenizer(details_text, return_tensors="pt", padding=True,
-                           truncation=True, max_length=512).to(device)
-        model.set_active_adapters("details")
-        out = model(**tokens)
-        doc_emb_details[eid] = out.last_hidden_state[:, 0, :].squeeze(0)
-
-        # For feature summary.
-        tokens = tokenizer(feature_text, return_tensors="pt", padding=True,
-                           truncation=True, max_length=512).to(device)
-        model.set_active_adapters("feature_summary")
-        out = model(**tokens)
-        doc_emb_feature[eid] = out.last_hidden_state[:, 0, :].squeeze(0)
-
-# Define a helper function to compute the dot product between two embeddings.
-def dot_product(a: torch.Tensor, b: torch.Tensor) -> float:
-    return torch.dot(a, b).item()
+def embedding_cache_version():
+    """
+    Returns a hash of everything the precomputed embeddings depend on: the base model and
+    its resolved revision, the encoding precision, the adapter weight files, the data file
+    and the per-adapter encoding settings.
+    """
+    digest = hashlib.sha256()
+    digest.update(BASE_MODEL.encode("utf-8"))
+    # The commit hash the base model resolves to, so that an upstream update of the model
+    # invalidates the cache. It is None when the model is loaded from a local directory.
+    digest.update(str(AutoConfig.from_pretrained(BASE_MODEL)._commit_hash).encode("utf-8"))
+    digest.update(f"autocast={use_autocast}".encode("utf-8"))
+    digest.update(repr(adapter_passes).encode("utf-8"))
+    for name, path in ADAPTER_PATHS.items():
+        digest.update(name.encode("utf-8"))
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file_name in sorted(files):
+                file_path = os.path.join(root, file_name)
+                digest.update(os.path.relpath(file_path, path).encode("utf-8"))
+                with open(file_path, "rb") as f:
+                    digest.update(f.read())
+    with open(DATA_PATH, "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+# Number of texts encoded per forward pass.
+BATCH_SIZE = 32
+
+# Side stream used to copy token batches to the GPU while the previous batch is encoded.
+copy_stream = torch.cuda.Stream() if device.type == "cuda" else None
+
+def tokenize(texts, max_length):
+    """
+    Tokenizes a list of texts into padded batches of up to BATCH_SIZE texts and returns
+    a list of (positions, tokens) pairs, where positions is a tensor of the indices of the
+    batch's texts in the input. Texts are tokenized once without padding and sorted by token
+    length, so each batch only pads up to the longest of similarly sized inputs.
+    On GPU the batches are pinned for asynchronous copies.
+    """
+    encoded = tokenizer(texts, truncation=True, max_length=max_length)
+    lengths = [len(input_ids) for input_ids in encoded["input_ids"]]
+    order = sorted(range(len(texts)), key=lengths.__getitem__)
+    batches = []
+    for start in range(0, len(order), BATCH_SIZE):
+        chunk = order[start:start + BATCH_SIZE]
+        positions = torch.tensor(chunk)
+        tokens = tokenizer.pad({k: [v[i] for i in chunk] for k, v in encoded.items()},
+                               padding=True, return_tensors="pt")
+        if copy_stream is not None:
+            positions = positions.pin_memory()
+            tokens = {k: v.pin_memory() for k, v in tokens.items()}
+        batches.append((positions, tokens))
+    return batches
+
+def to_device(batch):
+    """
+    Starts moving a (positions, tokens) batch from tokenize() to the device and returns
+    (positions, tokens, ready). On GPU the copy runs asynchronously on copy_stream, and
+    ready is an event recorded once the copy has been issued. On CPU ready is None.
+    """
+    positions, tokens = batch
+    if copy_stream is None:
+        return positions.to(device), {k: v.to(device) for k, v in tokens.items()}, None
+    with torch.cuda.stream(copy_stream):
+        gpu_positions = positions.to(device, non_blocking=True)
+        gpu_tokens = {k: v.to(device, non_blocking=True) for k, v in tokens.items()}
+    ready = torch.cuda.Event()
+    ready.record(copy_stream)
+    return gpu_positions, gpu_tokens, ready
+
+def encode(batches, embeddings, desc):
+    """
+    Encodes batches produced by tokenize() with the currently active adapter and writes
+    their CLS embeddings into the rows of embeddings that match the original texts.
+    The next batch is copied to the device while the current one runs through the encoder.
+    """
+    pending = to_device(batches[0]) if batches else None
+    for b in tqdm(range(len(batches)), desc=desc, unit="batch"):
+        positions, tokens, ready = pending
+        if ready is not None:
+            # Wait for the copy, and tell the allocator the batch is used on this stream.
+            compute_stream = torch.cuda.current_stream()
+            compute_stream.wait_event(ready)
+            positions.record_stream(compute_stream)
+            for v in tokens.values():
+                v.record_stream(compute_stream)
+        # Run the encoder in bfloat16 on GPU; inference only, so no loss scaling is needed.
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16,
+                            enabled=use_autocast):
+            out = model(**tokens)
+        # The forward pass is queued asynchronously, so issue the next copy meanwhile.
+        if b + 1 < len(batches):
+            pending = to_device(batches[b + 1])
+        # Store the CLS rows (back in FP32) in place. Indexing with a device tensor keeps
+        # the host from blocking on the forward pass.
+        embeddings[positions] = out.last_hidden_state[:, 0, :].float()
+
+# One row per id, in the same order for the query and document matrices.
+ids = list(data_dict)
+records = list(data_dict.values())
+num_records = len(ids)
+
+cache_version = embedding_cache_version()
+cached = None
+if os.path.exists(EMBEDDING_CACHE_PATH):
+    cached = torch.load(EMBEDDING_CACHE_PATH, mmap=True, weights_only=True)
+    if cached["version"] != cache_version or cached["ids"] != ids:
+        print(f"Embedding cache at '{EMBEDDING_CACHE_PATH}' is out of date; recomputing embeddings.")
+        cached = None
+
+if cached is not None:
+    print(f"Loading precomputed embeddings from '{EMBEDDING_CACHE_PATH}'.")
+    Q_t, Q_d, Q_f, D_t, D_d, D_f = (cached[name].to(device)
+                                    for name in ("Q_t", "Q_d", "Q_f", "D_t", "D_d", "D_f"))
+    del cached
+else:
+    # Load base model and tokenizer.
+    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL)
+    model = AutoAdapterModel.from_pretrained(BASE_MODEL)
+    model.to(device)
+
+    for name, path in ADAPTER_PATHS.items():
+        model.load_adapter(path, load_as=name)
+    model.to(device)
+    model.eval()
+
+    hidden_size = model.config.hidden_size
+
+    # Contiguous (N, D) embedding matrices for queries and documents, one per adapter,
+    # so that all query-document dot products for an adapter come from a single matrix multiply.
+    Q_t = torch.empty(num_records, hidden_size, device=device)
+    Q_d = torch.empty(num_records, hidden_size, device=device)
+    Q_f = torch.empty(num_records, hidden_size, device=device)
+    D_t = torch.empty(num_records, hidden_size, device=device)
+    D_d = torch.empty(num_records, hidden_size, device=device)
+    D_f = torch.empty(num_records, hidden_size, device=device)
+
+    # Precompute embeddings for each data point.
+    # We compute query embeddings (using each adapter) on the record["query"]
+    # and document embeddings on the corresponding fields.
+    query_texts = [record["query"] for record in records]
+
+    # Repeated queries only need to be encoded once per adapter; query_rows maps each
+    # record to the row of its query text among the unique queries.
+    unique_queries = list(dict.fromkeys(query_texts))
+    query_index = {query: i for i, query in enumerate(unique_queries)}
+    query_rows = torch.tensor([query_index[q] for q in query_texts], device=device)
+
+    with torch.inference_mode():
+        # The same query tokens are fed to all three adapters, so tokenize them only once.
+        query_batches = tokenize(unique_queries, 128)
+        unique_q = torch.empty(len(unique_queries), hidden_size, device=device)
+
+        for (adapter, field, max_length), Q, D in zip(adapter_passes, (Q_t, Q_d, Q_f), (D_t, D_d, D_f)):
+            # Activate each adapter once and stream every query and document through it.
+            model.set_active_adapters(adapter)
+
+            # --- Query embeddings ---
+            encode(query_batches, unique_q, f"Query embeddings ({adapter})")
+            torch.index_select(unique_q, 0, query_rows, out=Q)
+
+            # --- Document embeddings ---
+            doc_batches = tokenize([record[field] for record in records], max_length)
+            encode(doc_batches, D, f"Document embeddings ({adapter})")
+
+    torch.save({"version": cache_version, "ids": ids,
+                "Q_t": Q_t.cpu(), "Q_d": Q_d.cpu(), "Q_f": Q_f.cpu(),
+                "D_t": D_t.cpu(), "D_d": D_d.cpu(), "D_f": D_f.cpu()},
+               EMBEDDING_CACHE_PATH)
+    print(f"Embeddings have been saved to '{EMBEDDING_CACHE_PATH}'.")
+
+    # The encoder and the token batches are not needed past this point.
+    del model, tokenizer, query_batches, doc_batches, unique_q
+
+# Per-adapter similarity matrices. Row q, column d holds the dot product between
+# query q and document d. They depend only on the embeddings, so they are computed
+# once and shared by the ranking export and every hill-climbing evaluation.
+# They are stacked as (3, N, N) so that weight vectors can be applied in a single contraction.
+with torch.inference_mode():
+    S = torch.stack([Q_t @ D_t.T, Q_d @ D_d.T, Q_f @ D_f.T])
+
+# Only the similarity matrices are used from here on, so release the embedding matrices
+# and hand the freed blocks back to the device before hill climbing.
+del Q_t, Q_d, Q_f, D_t, D_d, D_f
+if device.type == "cuda":
+    torch.cuda.empty_cache()
+
+# The "relevant" document for query i is document i (same id as the query).
+relevant = torch.arange(num_records, device=device).unsqueeze(1)
+
+# Weights [w_title, w_details, w_feature] used for the ranking export, depending on whether
+# the document's feature summary is available.
+DEFAULT_WEIGHTS = [0.1, 0.6, 0.3]
+UNAVAILABLE_WEIGHTS = [0.1, 0.9, 0.0]
+
+# Documents whose feature summary is missing, in the same order as the matrix columns,
+# and the resulting (3, N) per-document weights, built once so scoring has no branches.
+unavail = torch.tensor([record["feature_summary"] == "[UNAVAILABLE]" for record in records],
+                       device=device)
+doc_weights = torch.where(unavail,
+                          torch.tensor(UNAVAILABLE_WEIGHTS, device=device).unsqueeze(1),
+                          torch.tensor(DEFAULT_WEIGHTS, device=device).unsqueeze(1))
 
 # Now, for every query, rank every document using the composite similarity score.
 # For a given query-document pair, we compute:
@@ -104,37 +252,21 @@ def dot_product(a: torch.Tensor, b: torch.Tensor) -> float:
 #   If document's feature_summary == "[UNAVAILABLE]": w_title=0.1, w_details=0.9, w_feature=0.0
 ranking = {}
 
-with torch.no_grad():
-    for qid in tqdm(query_emb_title.keys(), desc="Ranking queries", unit="query"):
-        scores = {}
-        # Query embeddings for this query.
-        q_title = query_emb_title[qid]
-        q_details = query_emb_details[qid]
-        q_feature = query_emb_feature[qid]
-
-        for did in doc_emb_title.keys():
-            # Document embeddings for this document.
-            d_title = doc_emb_title[did]
-            d_details = doc_emb_details[did]
-            d_feature = doc_emb_feature[did]
-
-            # Check the feature summary field from the original data.
-            record = data_dict[did]
-            if record["feature_summary"] == "[UNAVAILABLE]":
-                w_title, w_details, w_feature = 0.1, 0.9, 0.0
-            else:
-                w_title, w_details, w_feature = 0.1, 0.6, 0.3
-
-            sim_title = dot_product(q_title, d_title)
-            sim_details = dot_product(q_details, d_details)
-            sim_feature = dot_product(q_feature, d_feature)
-
-            composite_score = w_title * sim_title + w_details * sim_details + w_feature * sim_feature
-            scores[did] = composite_score
-
-        # Rank the document ids for this query in descending order of composite score.
-        ranked_doc_ids = sorted(scores, key=scores.get, reverse=True)
-        ranking[qid] = ranked_doc_ids
+with torch.inference_mode():
+    # Weight every document column with its own (w_title, w_details, w_feature).
+    composite = torch.einsum("wd,wqd->qd", doc_weights, S)
+
+    # Rank the documents for every query in descending order of composite score.
+    # A stable sort keeps tied documents in their original order.
+    # The order stays a CPU tensor and is converted one row at a time, so only a single
+    # row of Python ints exists alongside the ranking.
+    order = torch.argsort(composite, dim=1, descending=True, stable=True).cpu()
+
+    del composite
+
+for qid, doc_rows in tqdm(zip(ids, order), total=num_records, desc="Ranking queries", unit="query"):
+    ranking[qid] = [ids[row] for row in doc_rows.tolist()]
+del order
 
 # Export the ranking dictionary to a JSON file.
 with open("../data/data/2_intermediate_data/partial_rep_rankings_val.json", "w", encoding="utf-8") as f:
@@ -143,45 +275,33 @@ with open("../data/data/2_intermediate_data/partial_rep_rankings_val.json", "w",
 print("Ranking complete. Rankings have been saved to 'rankings.json'.")
 
 # Define evaluation metric function
+def eval_metrics(candidates):
+    """
+    Given a list of K weight vectors [w_title, w_details, w_feature], compute the top-10
+    accuracy of each over the reliable dataset in one batched pass. For each query, we rank
+    every candidate document (using the same dataset) by the composite score computed as the
+    weighted sum of dot products between the query and document embeddings. A query is counted
+    as a hit if its own document appears in the top 10. Returns a list of K accuracies.
+    """
+    W = torch.tensor(candidates, dtype=S.dtype, device=device)
+
+    with torch.inference_mode():
+        # (K, N, N) composite scores, one matrix per weight vector.
+        composite = torch.einsum("kw,wqd->kqd", W, S)
+        # Indices of the 10 highest scoring candidates for each query.
+        top10 = torch.topk(composite, k=min(10, num_records), dim=2).indices
+        correct = (top10 == relevant).any(dim=2).sum(dim=1)
+    return (correct / num_records).tolist()
+
 def eval_metric(weights):
     """
-    Given weights [w_title, w_details, w_feature], compute the top-10 accuracy over the
-    reliable dataset. For each query, we rank every candidate document (using the same dataset)
-    by the composite score computed as the weighted sum of dot products between the query and
-    document embeddings. A query is counted as a hit if its own document appears in the top 10.
+    Top-10 accuracy for a single weight vector [w_title, w_details, w_feature].
     """
-    w_title, w_details, w_feature = weights
-    total = len(query_emb_title)
-    correct = 0
-
-    # For each query (keyed by record id)
-    for rid in query_emb_title.keys():
-        scores = {}
-        # Retrieve query embeddings for this record.
-        q_title = query_emb_title[rid]
-        q_details = query_emb_details[rid]
-        q_feature = query_emb_feature[rid]
-
-        # Score every candidate document.
-        for cid in doc_emb_title.keys():
-            # Compute dot products for each branch.
-            sim_title = torch.dot(q_title, doc_emb_title[cid]).item()
-            sim_details = torch.dot(q_details, doc_emb_details[cid]).item()
-            sim_feature = torch.dot(q_feature, doc_emb_feature[cid]).item()
-            # Composite similarity using the candidate weights.
-            composite = w_title * sim_title + w_details * sim_details + w_feature * sim_feature
-            scores[cid] = composite
-
-        # Rank candidates in descending order (highest similarity first).
-        ranked = sorted(scores, key=scores.get, reverse=True)
-        # Check if the "relevant" document (same id as the query) is in the top 10.
-        if rid in ranked[:10]:
-            correct += 1
-    return correct / total
+    return eval_metrics([weights])[0]
 
 # Hill Climbing Optimization
 
-current_weights = [0.1, 0.6, 0.3]
+current_weights = list(DEFAULT_WEIGHTS)
 current_metric = eval_metric(current_weights)
 print("Initial weights:", current_weights, "Metric:", current_metric)
 
@@ -193,6 +313,8 @@ improved = True
 while improved and iteration < max_iters:
     improved = False
     iteration += 1
+    # Every neighbour of the current weights, moving one weight by +/- step_size.
+    candidates = []
     for i in range(3):
         for delta in [step_size, -step_size]:
             candidate = current_weights.copy()
@@ -200,15 +322,18 @@ while improved and iteration < max_iters:
             # Ensure that weight values do not become negative.
             if candidate[i] < 0:
                 continue
-            candidate_metric = eval_metric(candidate)
-            if candidate_metric > current_metric:
-                current_metric = candidate_metric
-                current_weights = candidate
-                improved = True
-                print(f"Iteration {iteration}: Improved weights to {current_weights} with metric {current_metric:.4f}")
+            candidates.append(candidate)
+    # Evaluate all neighbours at once and move to the best one if it improves the metric.
+    candidate_metrics = eval_metrics(candidates)
+    best = max(range(len(candidates)), key=candidate_metrics.__getitem__)
+    if candidate_metrics[best] > current_metric:
+        current_metric = candidate_metrics[best]
+        current_weights = candidates[best]
+        improved = True
+        print(f"Iteration {iteration}: Improved weights to {current_weights} with metric {current_metric:.4f}")
     if not improved:
         print(f"No improvement in iteration {iteration}; terminating hill climbing.")
         break
 
 print("Best weights found:", current_weights)
-print("Top-10 accuracy (proportion of queries with relevant doc in top 10):", current_metric)
\ No newline at end of file
+print("Top-10 accuracy (proportion of queries with relevant doc in top 10):", current_metric)
@@ -101,12 +101,16 @@ with torch.no_grad():
 # is mapped to a list of document ids ranked by similarity (highest first).
 ranking = {}
 
+# Stack the document embeddings into an (N, D) matrix, one row per document id, so that
+# each query is scored against every document on the device with a single host sync.
+doc_ids = list(document_embeddings.keys())
+doc_matrix = torch.cat([document_embeddings[did] for did in doc_ids])
+
 for qid, q_emb in tqdm(query_embeddings.items(), desc="Ranking documents", unit="query"):
-    scores = {}
-    # Compute dot product similarity between the query embedding and every document embedding.
-    for did, d_emb in document_embeddings.items():
-        sim_score = torch.sum(q_emb * d_emb).item()
-        scores[did] = sim_score
+    # Compute dot product similarity between the query embedding and every document embedding,
+    # then copy all of this query's scores to the host at once.
+    sim_scores = doc_matrix @ q_emb.squeeze(0)
+    scores = dict(zip(doc_ids, sim_scores.tolist()))
     # Sort document ids based on similarity scores in descending order.
     ranked_doc_ids = sorted(scores, key=scores.get, reverse=True)
     ranking[qid] = ranked_doc_ids